@@ -65,6 +65,24 @@ def main():
     except:
         hash_function = None
 
+    # Check if a fetch_method is defined
+    try:
+        fetch_method = config['fetch_method']
+    except:
+        fetch_method = None
+
+    # Check if the dists to mirror over http are defined
+    try:
+        dists = config['dists']
+    except:
+        dists = None
+
+    # Check if the number of parallel http downloads is defined
+    try:
+        http_workers = config['http_workers']
+    except:
+        http_workers = None
+
     # Create a file for logging in the location defined by the config file
     try:
         log_file = config['log_file']
@@ -77,12 +95,14 @@ def main():
                     mirror_url=config['mirror_url'],
                     temp_indices=temp_indices,
                     log_file=log_file, log_level=log_level,
-                    package_ttl=package_ttl, hash_function=hash_function)
+                    package_ttl=package_ttl, hash_function=hash_function,
+                    fetch_method=fetch_method, dists=dists,
+                    http_workers=http_workers)
 
     # If a -U option is used, only update the 'pool' directory. This only grabs
     # new packages
     if args.update_packages_only:
-        mirror.update_pool()
+        mirror.update_packages()
 
     # If a -U option is not used, attempt to update the whole mirror
     else:
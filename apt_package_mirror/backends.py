@@ -0,0 +1,498 @@
+from __future__ import print_function
+import os
+import re
+import socket
+from subprocess import Popen, PIPE
+import time
+
+from apt_package_mirror.exceptions import MirrorException
+from apt_package_mirror.http_fetch import HttpFetcher, parse_release
+
+# xz compressed indices can only be read if the lzma module is available
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# Extensions of the Packages and Sources indices Mirror can read
+if lzma:
+    INDEX_EXTENSIONS = ('', '.gz', '.bz2', '.xz')
+else:
+    INDEX_EXTENSIONS = ('', '.gz', '.bz2')
+
+
+# Join a path taken from the mirror we are cloning from onto base. Returns
+# None for absolute paths, paths with a '..' component and anything else that
+# would end up outside of base, a hostile mirror could otherwise write
+# anywhere we can.
+def _safe_join(base, name):
+    if os.path.isabs(name) or '..' in name.split('/'):
+        return None
+
+    base = os.path.normpath(base)
+    path = os.path.normpath(os.path.join(base, name))
+    if not path.startswith(base + os.sep):
+        return None
+
+    return path
+
+
+# Download stages that go over rsync://, the mirror we are cloning from has to
+# run an rsync daemon
+class RsyncBackend:
+
+    # The pool is synced as a whole, it does not need the indices
+    pool_from_indices = False
+
+    def __init__(self, mirror):
+        self.mirror = mirror
+        self.logger = mirror.logger
+
+    # Update the pool directory of the mirror
+    def update_pool(self):
+        rsync_command = "rsync --recursive --times --links --hard-links \
+                --contimeout=10 --timeout=10 --no-motd --stats \
+                --progress \
+                -vz rsync://{mirror_url}/pool {mirror_path}/"
+        rsync_command = rsync_command.format(
+                mirror_url=self.mirror.mirror_url,
+                mirror_path=self.mirror.mirror_path
+            )
+
+        self.logger.info("Downloading new packages")
+        rsync_status = Popen(rsync_command, stdout=PIPE, stderr=PIPE,
+                             shell=True)
+
+        for line in rsync_status.stdout:
+            self.logger.debug(line)
+
+    # Update the entire mirror, excluding package, source, and release indices
+    def update_mirrors(self):
+        rsync_command = "rsync --recursive --times --links --hard-links \
+                --exclude 'Packages*' --exclude 'Sources*' \
+                --exclude 'Release*' --exclude 'ls-lR.gz' --exclude 'pool' \
+                --contimeout=10 --timeout=10 --no-motd --delete --stats \
+                --delay-updates --progress \
+                -vz rsync://{mirror_url}/ {mirror_path}/"
+        rsync_command = rsync_command.format(
+                mirror_url=self.mirror.mirror_url,
+                mirror_path=self.mirror.mirror_path
+            )
+
+        self.logger.info("Downloading all new files except indices")
+        rsync_status = Popen(rsync_command, stdout=PIPE, stderr=PIPE,
+                             shell=True)
+
+        for line in rsync_status.stdout:
+            self.logger.debug(line)
+
+    # Download the 'dists' directory and place it in a
+    # temporary place so it can be checked to make sure it is accurate
+    def get_dists_indices(self):
+        rsync_command = "rsync --recursive --times --links --hard-links \
+                --exclude 'installer*' --delete --no-motd --stats\
+                --progress \
+                -vz rsync://{mirror_url}/dists {temp_indices}/"
+        rsync_command = rsync_command.format(
+                mirror_url=self.mirror.mirror_url,
+                temp_indices=self.mirror.temp_indices
+            )
+
+        self.logger.info(
+                ("Downloading dist indices and storing them "
+                 "in a temporary place")
+            )
+        rsync_status = Popen(rsync_command, stdout=PIPE, stderr=PIPE,
+                             shell=True)
+
+        for line in rsync_status.stdout:
+            self.logger.debug(line)
+
+    # Download the 'zzz-dists' directory and place it in a
+    # temporary place so it can be checked to make sure it is accurate
+    # NOTE: This is for Debian compatibility, this should do nothing in an
+    #       ubuntu mirror because they do not have the 'zzz-dists' dir, but
+    #       debian symlinks some things in the 'dists' dir to 'zzz-dists'
+    def get_zzz_dists(self):
+        rsync_command = "rsync --recursive --times --links --hard-links \
+                --exclude 'installer*' --delete --no-motd --stats\
+                --progress \
+                -vz rsync://{mirror_url}/zzz-dists {temp_indices}/"
+        rsync_command = rsync_command.format(
+                mirror_url=self.mirror.mirror_url,
+                temp_indices=self.mirror.temp_indices
+            )
+
+        self.logger.info(
+                "Downloading zzz-dists and storing them in a temporary place"
+            )
+        rsync_status = Popen(rsync_command, stdout=PIPE, stderr=PIPE,
+                             shell=True)
+
+        for line in rsync_status.stdout:
+            self.logger.debug(line)
+
+    # Update the 'project' directory, delete the files that do not exist on the
+    # mirror you are cloning from, then add an entry for our mirror in
+    # project/trace
+    def update_project_dir(self):
+        rsync_command = "rsync --recursive --times --links --hard-links \
+                --progress --delete -vz --stats --no-motd \
+                rsync://{mirror_url}/project {mirror_path}/ && date -u \
+                > ${mirror_path}/project/trace/$(hostname -f)"
+
+        rsync_command = rsync_command.format(
+                mirror_url=self.mirror.mirror_url,
+                mirror_path=self.mirror.mirror_path
+            )
+
+        self.logger.info("Updating 'project' directory")
+        rsync_status = Popen(rsync_command, stdout=PIPE, stderr=PIPE,
+                             shell=True)
+
+        for line in rsync_status.stdout:
+            self.logger.debug(line)
+
+    # Ask rsync which files in our pool the mirror we are cloning from has
+    # deleted
+    def get_deleted_packages(self):
+        rsync_command = "rsync --recursive --times --links --hard-links \
+                --contimeout=10 --timeout=10 --no-motd --stats --delete \
+                --progress -nvz rsync://{mirror_url}/pool {mirror_path}/"
+        rsync_command = rsync_command.format(
+            mirror_url=self.mirror.mirror_url,
+            mirror_path=self.mirror.mirror_path
+        )
+
+        rsync_status = Popen(rsync_command, stdout=PIPE, stderr=PIPE,
+                             shell=True)
+
+        deleted_packages = []
+        for line in rsync_status.stdout:
+            if re.match('^deleting', line):
+                deleted_packages.append(line.split()[1])
+
+        return deleted_packages
+
+
+# Download stages that go over http(s). Directories can not be listed over
+# http, so the dists to mirror are named in the config file and the pool is
+# downloaded from the file lists in their indices.
+class HttpBackend:
+
+    # update_pool() needs the indices staged by get_dists_indices()
+    pool_from_indices = True
+
+    def __init__(self, mirror, dists, workers=None):
+        if not dists:
+            raise MirrorException(
+                    "'dists' must be set when using the http fetch method"
+                )
+
+        self.mirror = mirror
+        self.logger = mirror.logger
+        self.dists = dists
+        self.fetcher = HttpFetcher(mirror.mirror_url, workers=workers,
+                                   logger=mirror.logger)
+
+        # Set by get_dists_indices(), clean() must not delete anything unless
+        # every Packages and Sources index was staged
+        self.indices_complete = False
+
+    # Download every file the staged indices reference into the pool
+    def update_pool(self):
+        pool_files = {}
+        for index in self.mirror._pick_indices(self.mirror.temp_indices):
+            for file_name, size, hash_val in self._get_index_files(index):
+                pool_files[file_name] = (size, hash_val)
+
+        self.logger.info("Downloading new packages")
+        to_fetch = []
+        for file_name in pool_files:
+            size, hash_val = pool_files[file_name]
+            to_fetch.append((file_name,
+                             os.path.join(self.mirror.mirror_path, file_name),
+                             size, hash_val))
+
+        for file_name in self.fetcher.fetch_all(to_fetch):
+            self.logger.warning("File not found on mirror: " + file_name)
+
+    def update_mirrors(self):
+        self.logger.info(
+                "Skipping files outside of 'dists' and 'pool', they can "
+                "not be listed over http"
+            )
+
+    # Download the InRelease file of each dist in the config file and every
+    # index it lists into a temporary place. When the dist supports it the
+    # indices are fetched from their 'by-hash' path so they can not change
+    # underneath us while a mirror push is in progress.
+    def get_dists_indices(self):
+        self.logger.info(
+                ("Downloading dist indices and storing them "
+                 "in a temporary place")
+            )
+
+        self.indices_complete = True
+        dists_path = os.path.join(self.mirror.temp_indices, 'dists')
+        kept = set()
+        for dist in self.dists:
+            kept.update(self._get_dist(dist, os.path.join(dists_path, dist)))
+
+        # Remove anything left over from indices that are no longer published
+        for root, dirs, files in os.walk(dists_path):
+            for file_name in files:
+                file_path = os.path.join(root, file_name)
+                if file_path not in kept:
+                    self.logger.debug("Removing " + file_path)
+                    os.remove(file_path)
+
+    # The http server follows the symlinks into 'zzz-dists' for us
+    def get_zzz_dists(self):
+        pass
+
+    def update_project_dir(self):
+        self.logger.info(
+                "'project' directory can not be listed over http, only "
+                "updating the trace file"
+            )
+        trace_dir = os.path.join(self.mirror.mirror_path, 'project', 'trace')
+        if not os.path.isdir(trace_dir):
+            os.makedirs(trace_dir)
+
+        with open(os.path.join(trace_dir, socket.getfqdn()), 'w') as f:
+            f.write(time.strftime('%a %b %d %H:%M:%S UTC %Y\n', time.gmtime()))
+
+    # Find the files in our pool that no index of the configured dists
+    # references. Nothing is returned unless all of the indices were staged,
+    # otherwise the packages of a missing index would be deleted.
+    def get_deleted_packages(self):
+        if not self.indices_complete or not self.mirror.indexed_packages:
+            self.logger.warning(
+                    "Not all indices were downloaded, not scheduling any "
+                    "packages for deletion"
+                )
+            return []
+
+        deleted_packages = []
+        pool_path = os.path.join(self.mirror.mirror_path, 'pool')
+        for root, dirs, files in os.walk(pool_path):
+            for file_name in files:
+                package = os.path.relpath(os.path.join(root, file_name),
+                                          self.mirror.mirror_path)
+                if package not in self.mirror.indexed_packages:
+                    deleted_packages.append(package)
+
+        return deleted_packages
+
+    # Download the Release files of a single dist and the indices they list,
+    # returns the local paths of everything that was downloaded
+    def _get_dist(self, dist, dist_path):
+        kept = set()
+        release = None
+        for name in ('InRelease', 'Release', 'Release.gpg'):
+            local_path = os.path.join(dist_path, name)
+            if self.fetcher.fetch('dists/' + dist + '/' + name, local_path):
+                kept.add(local_path)
+                if release is None and name != 'Release.gpg':
+                    release = local_path
+
+        if release is None:
+            raise MirrorException("No Release file found for " + dist)
+
+        with open(release, 'r') as f_stream:
+            release_files, by_hash = parse_release(f_stream.read())
+
+        # The indices are checked against InRelease, a Release file that
+        # does not match it was fetched while a mirror push was in progress
+        # and is not staged
+        if release.endswith('/InRelease') and \
+                os.path.join(dist_path, 'Release') in kept:
+            with open(os.path.join(dist_path, 'Release'), 'r') as f_stream:
+                if parse_release(f_stream.read()) != (release_files, by_hash):
+                    self.logger.warning(
+                            "Release for " + dist + " does not match "
+                            "InRelease, only staging InRelease"
+                        )
+                    kept.discard(os.path.join(dist_path, 'Release'))
+                    kept.discard(os.path.join(dist_path, 'Release.gpg'))
+
+        checked_files = []
+        for file_name, size, hash_val in release_files:
+            if re.match("(.*/)?installer", file_name):
+                continue
+
+            if _safe_join(dist_path, file_name) is None or \
+                    not re.match("^[0-9a-f]{64}$", hash_val):
+                self.logger.warning(
+                        "Skipping unsafe entry " + file_name + " in " + release
+                    )
+                continue
+
+            checked_files.append((file_name, size, hash_val))
+        release_files = checked_files
+
+        to_fetch = {}
+        for file_name, size, hash_val in release_files:
+            if by_hash:
+                file_name = self._by_hash_name(file_name, hash_val)
+
+            local_path = os.path.join(dist_path, file_name)
+            to_fetch[local_path] = ('dists/' + dist + '/' + file_name,
+                                    local_path, size, hash_val)
+
+        missing = self.fetcher.fetch_all(list(to_fetch.values()),
+                                         quick=by_hash)
+
+        # Not everything in a Release file is published by-hash (Debian does
+        # not do it for the per component Release files), so like apt we
+        # fall back to the canonical path
+        found = set()
+        fallback = {}
+        for file_name, size, hash_val in release_files:
+            local_path = os.path.join(dist_path, file_name)
+            if not by_hash:
+                if 'dists/' + dist + '/' + file_name not in missing:
+                    found.add(file_name)
+                continue
+
+            hash_name = self._by_hash_name(file_name, hash_val)
+            if 'dists/' + dist + '/' + hash_name in missing:
+                fallback['dists/' + dist + '/' + file_name] = (
+                    file_name, size, hash_val
+                )
+                continue
+
+            hash_path = os.path.join(dist_path, hash_name)
+            kept.add(hash_path)
+            if os.path.exists(local_path):
+                os.remove(local_path)
+            os.link(hash_path, local_path)
+            found.add(file_name)
+
+        to_fetch = []
+        for remote_path in fallback:
+            file_name, size, hash_val = fallback[remote_path]
+            to_fetch.append((remote_path, os.path.join(dist_path, file_name),
+                             size, hash_val))
+
+        missing = self.fetcher.fetch_all(to_fetch, quick=False)
+        for remote_path in fallback:
+            if remote_path not in missing:
+                found.add(fallback[remote_path][0])
+
+        # Release files commonly list indices that are not published, usually
+        # the uncompressed ones, so it is only a problem if none of the
+        # variants of a Packages or Sources index we can read were found
+        needed = {}
+        for file_name, size, hash_val in release_files:
+            match = re.match("(.*)(Packages|Sources)(\.\w+)?$", file_name)
+            if match:
+                needed[match.group(1) + match.group(2)] = True
+
+            if file_name in found:
+                kept.add(os.path.join(dist_path, file_name))
+                continue
+
+            self.logger.warning(
+                    "Index listed in " + release + " not found on mirror: " +
+                    file_name
+                )
+
+        for index in needed:
+            if not any(index + ext in found for ext in INDEX_EXTENSIONS):
+                self.logger.warning(
+                        "No readable copy of " + dist + "/" + index +
+                        " was found on the mirror"
+                    )
+                self.indices_complete = False
+
+        return kept
+
+    # Check that a file listed in an index ends up inside of our pool
+    def _in_pool(self, pool_file, index):
+        pool_path = os.path.join(os.path.normpath(self.mirror.mirror_path),
+                                 'pool')
+        path = _safe_join(self.mirror.mirror_path, pool_file)
+        if path is None or not path.startswith(pool_path + os.sep):
+            self.logger.warning(
+                    "Skipping " + pool_file + " in " + index +
+                    ", it is outside of the pool"
+                )
+            return False
+
+        return True
+
+    def _by_hash_name(self, file_name, hash_val):
+        return os.path.join(os.path.dirname(file_name), 'by-hash', 'SHA256',
+                            hash_val)
+
+    # Return (file_name, size, sha256) for each file listed in an index.
+    # Entries without a size and SHA256, or Sources entries without a
+    # Directory, are skipped since they can not be fetched and verified.
+    def _get_index_files(self, file_name):
+        f_contents = self.mirror._read_index(file_name)
+        files = []
+
+        if re.match(".*Packages(\.gz|\.bz2|\.xz)?$", file_name):
+            pool_file = None
+            size = None
+            hash_val = None
+            for line in f_contents.split('\n') + ['']:
+                if line.startswith("Filename:"):
+                    pool_file = line.split()[1]
+
+                elif line.startswith("Size:"):
+                    size = int(line.split()[1])
+
+                elif line.startswith("SHA256:"):
+                    hash_val = line.split()[1]
+
+                elif line == "":
+                    if pool_file and (size is None or hash_val is None):
+                        self.logger.warning(
+                                "Skipping " + pool_file + " in " + file_name +
+                                ", it has no Size or SHA256"
+                            )
+                    elif pool_file and self._in_pool(pool_file, file_name):
+                        files.append((pool_file, size, hash_val))
+                    pool_file = None
+                    size = None
+                    hash_val = None
+
+        elif re.match(".*Sources(\.gz|\.bz2|\.xz)?$", file_name):
+            package = None
+            dir_name = None
+            checksums = []
+            in_sha256 = False
+            for line in f_contents.split('\n') + ['']:
+                if line.startswith(" "):
+                    if in_sha256:
+                        checksums.append(line.split())
+
+                elif line == "":
+                    if checksums and dir_name is None:
+                        self.logger.warning(
+                                "Skipping source package " + str(package) +
+                                " in " + file_name + ", it has no Directory"
+                            )
+                        checksums = []
+
+                    for hash_val, size, source_file in checksums:
+                        source_file = os.path.join(dir_name, source_file)
+                        if self._in_pool(source_file, file_name):
+                            files.append((source_file, int(size), hash_val))
+                    package = None
+                    dir_name = None
+                    checksums = []
+                    in_sha256 = False
+
+                else:
+                    in_sha256 = line.startswith("Checksums-Sha256:")
+                    if line.startswith("Package:"):
+                        package = line.split()[1]
+
+                    elif line.startswith("Directory:"):
+                        dir_name = line.split()[1]
+
+        return files
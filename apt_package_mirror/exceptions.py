@@ -0,0 +1,6 @@
+class MirrorException(Exception):
+    def __init__(self, val):
+        self.val = val
+
+    def __str__(self):
+        return repr(self.val)
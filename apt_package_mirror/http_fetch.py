@@ -0,0 +1,402 @@
+from __future__ import print_function
+from email.utils import mktime_tz, parsedate_tz
+import hashlib
+import logging
+import os
+import socket
+import threading
+
+try:
+    import httplib
+    from Queue import Queue, Empty
+    from urlparse import urljoin, urlparse
+except ImportError:
+    import http.client as httplib
+    from queue import Queue, Empty
+    from urllib.parse import urljoin, urlparse
+
+from apt_package_mirror.exceptions import MirrorException
+
+CHUNK_SIZE = 64 * 1024
+MAX_REDIRECTS = 5
+
+
+# Keep idle keep-alive connections to a single host around so each download
+# does not have to pay for a new TCP (and TLS) handshake
+class ConnectionPool:
+
+    def __init__(self, scheme, host, port, timeout, size):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.size = size
+        self.idle = Queue()
+
+    # Grab an idle connection if there is one, otherwise open a new one
+    def get(self):
+        try:
+            return self.idle.get_nowait(), True
+        except Empty:
+            pass
+
+        if self.scheme == 'https':
+            conn = httplib.HTTPSConnection(self.host, self.port,
+                                           timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(self.host, self.port,
+                                          timeout=self.timeout)
+        return conn, False
+
+    # Hand a connection back, it is only kept if the server will keep it open
+    def put(self, conn):
+        if self.idle.qsize() < self.size:
+            self.idle.put(conn)
+        else:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Empty:
+                return
+
+
+# Fetch files from an http(s) mirror. Downloads are written to a '.partial'
+# file and hashed as they are written, so a file only lands in its final
+# location once its size and SHA256 have been verified. An interrupted
+# download is resumed with a Range request on the next run.
+class HttpFetcher:
+
+    def __init__(self, mirror_url, workers=None, timeout=None, logger=None):
+        if workers is None:
+            workers = 4
+
+        if timeout is None:
+            timeout = 10
+
+        if logger is None:
+            logger = logging.getLogger()
+
+        if '://' not in mirror_url:
+            mirror_url = 'http://' + mirror_url
+
+        if not mirror_url.endswith('/'):
+            mirror_url = mirror_url + '/'
+
+        self.base_url = mirror_url
+        self.workers = workers
+        self.timeout = timeout
+        self.logger = logger
+        self.pools = {}
+        self.pools_lock = threading.Lock()
+
+    def _get_pool(self, url):
+        parsed = urlparse(url)
+        if parsed.scheme not in ('http', 'https'):
+            raise MirrorException("Unsupported url: " + url)
+
+        key = (parsed.scheme, parsed.hostname, parsed.port)
+        with self.pools_lock:
+            if key not in self.pools:
+                self.pools[key] = ConnectionPool(
+                        parsed.scheme, parsed.hostname, parsed.port,
+                        self.timeout, self.workers
+                    )
+            return self.pools[key]
+
+    def close(self):
+        with self.pools_lock:
+            for pool in self.pools.values():
+                pool.close()
+
+    # Send a GET request and return the open response along with the pool
+    # and connection it belongs to. A pooled connection the server has
+    # silently closed is retried once on a fresh connection.
+    def _request(self, url, headers):
+        pool = self._get_pool(url)
+        parsed = urlparse(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path = path + '?' + parsed.query
+
+        while True:
+            conn, reused = pool.get()
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                return pool, conn, response
+
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not reused:
+                    raise
+
+    # Read the rest of a response so the connection can be used again
+    def _release(self, pool, conn, response):
+        try:
+            response.read()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            return
+
+        if response.will_close:
+            conn.close()
+        else:
+            pool.put(conn)
+
+    # Return a response for a path relative to the mirror, following
+    # redirects since CDNs commonly hand requests off to another host
+    def _open(self, path, headers):
+        url = urljoin(self.base_url, path)
+        for i in range(MAX_REDIRECTS + 1):
+            pool, conn, response = self._request(url, headers)
+            if response.status not in (301, 302, 303, 307, 308):
+                return pool, conn, response
+
+            location = response.getheader('Location')
+            self._release(pool, conn, response)
+            if not location:
+                raise MirrorException(
+                        "HTTP " + str(response.status) +
+                        " redirect without Location for " + path
+                    )
+            url = urljoin(url, location)
+
+        raise MirrorException("Too many redirects for " + path)
+
+    # Download path to local_path. If size and sha256 are given the file is
+    # verified before being moved into place. An existing file with the
+    # right size is kept, if quick is False its hash has to match as well.
+    # Returns False if the file does not exist on the mirror.
+    def fetch(self, path, local_path, size=None, sha256=None, quick=True):
+        if size is not None and os.path.isfile(local_path):
+            if os.path.getsize(local_path) == size:
+                if quick or sha256 is None or \
+                        self._hash_file(local_path) == sha256:
+                    return True
+
+        local_dir = os.path.dirname(local_path)
+        if not os.path.isdir(local_dir):
+            try:
+                os.makedirs(local_dir)
+            except OSError:
+                if not os.path.isdir(local_dir):
+                    raise
+
+        partial_path = local_path + '.partial'
+        validator_path = partial_path + '.validator'
+        hasher = hashlib.sha256()
+        offset = 0
+        validator = None
+        if os.path.isfile(validator_path):
+            with open(validator_path, 'r') as f_stream:
+                validator = f_stream.read().strip()
+
+        # A partial file is only resumed when the result can be verified and
+        # we know which version of the file it holds, otherwise old and new
+        # contents could end up joined together
+        if os.path.isfile(partial_path):
+            offset = os.path.getsize(partial_path)
+            if size is None or sha256 is None or not validator or \
+                    offset > size:
+                self._discard(partial_path)
+                offset = 0
+            else:
+                with open(partial_path, 'rb') as f_stream:
+                    for chunk in iter(lambda: f_stream.read(CHUNK_SIZE), b''):
+                        hasher.update(chunk)
+
+        # The partial file already holds the whole file, it only has to be
+        # verified
+        if offset and offset == size:
+            return self._finish(path, partial_path, local_path, size, sha256,
+                                hasher, None)
+
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes=' + str(offset) + '-'
+            headers['If-Range'] = validator
+            self.logger.debug(
+                    "Resuming " + path + " at byte " + str(offset)
+                )
+
+        pool, conn, response = self._open(path, headers)
+        try:
+            if response.status == 404:
+                self._release(pool, conn, response)
+                return False
+
+            content_range = response.getheader('Content-Range') or ''
+            if offset and (response.status == 416 or (
+                    response.status == 206 and not
+                    content_range.startswith('bytes ' + str(offset) + '-'))):
+                # The server does not agree with what we have, start over
+                self._release(pool, conn, response)
+                self._discard(partial_path)
+                return self.fetch(path, local_path, size, sha256, quick)
+
+            elif response.status in (200, 206):
+                if response.status == 200:
+                    hasher = hashlib.sha256()
+                    offset = 0
+                    self._save_validator(validator_path, response)
+
+                mode = 'ab' if offset else 'wb'
+                with open(partial_path, mode) as f_stream:
+                    while True:
+                        chunk = response.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        f_stream.write(chunk)
+                        hasher.update(chunk)
+
+                if response.will_close:
+                    conn.close()
+                else:
+                    pool.put(conn)
+
+            else:
+                self._release(pool, conn, response)
+                raise MirrorException(
+                        "HTTP " + str(response.status) + " for " + path
+                    )
+
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            raise
+
+        return self._finish(path, partial_path, local_path, size, sha256,
+                            hasher, response.getheader('Last-Modified'))
+
+    # Remember which version of the file a partial download holds so it is
+    # only resumed with a matching If-Range. Weak ETags can not be used for
+    # If-Range, so Last-Modified is used instead.
+    def _save_validator(self, validator_path, response):
+        validator = response.getheader('ETag')
+        if not validator or validator.startswith('W/'):
+            validator = response.getheader('Last-Modified')
+
+        if validator:
+            with open(validator_path, 'w') as f_stream:
+                f_stream.write(validator)
+
+        elif os.path.exists(validator_path):
+            os.remove(validator_path)
+
+    def _discard(self, partial_path):
+        for file_path in (partial_path, partial_path + '.validator'):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    # Verify a finished '.partial' download and move it into place
+    def _finish(self, path, partial_path, local_path, size, sha256, hasher,
+                last_modified):
+        actual_size = os.path.getsize(partial_path)
+        if size is not None and actual_size != size:
+            if actual_size > size:
+                self._discard(partial_path)
+            raise MirrorException(
+                    "Expected " + str(size) + " bytes but got " +
+                    str(actual_size) + " for file " + path
+                )
+
+        actual_sha256 = hasher.hexdigest()
+        if sha256 is not None and actual_sha256 != sha256:
+            self._discard(partial_path)
+            raise MirrorException(
+                    actual_sha256 + ' does not match ' + sha256 +
+                    ' for file ' + path + ' (SHA256)'
+                )
+
+        os.rename(partial_path, local_path)
+        self._discard(partial_path)
+
+        if last_modified and parsedate_tz(last_modified):
+            mtime = mktime_tz(parsedate_tz(last_modified))
+            os.utime(local_path, (mtime, mtime))
+
+        self.logger.debug("Downloaded " + path)
+        return True
+
+    # Download a list of (path, local_path, size, sha256) tuples using a
+    # pool of worker threads. Every file is attempted, then a
+    # MirrorException is raised if any of them failed. Returns the files
+    # that were not found on the mirror.
+    def fetch_all(self, files, quick=True):
+        queue = Queue()
+        for item in files:
+            queue.put(item)
+
+        missing = []
+        errors = []
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                try:
+                    path, local_path, size, sha256 = queue.get_nowait()
+                except Empty:
+                    return
+
+                try:
+                    if not self.fetch(path, local_path, size, sha256, quick):
+                        with lock:
+                            missing.append(path)
+                except Exception as e:
+                    self.logger.error("Failed to download " + path +
+                                      ": " + str(e))
+                    with lock:
+                        errors.append(path)
+
+        threads = []
+        for i in range(min(self.workers, queue.qsize()) or 1):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        # Join with a timeout, a plain join() can not be interrupted with
+        # Ctrl-C on python 2
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+
+        if errors:
+            raise MirrorException(
+                    "Failed to download " + str(len(errors)) + " files"
+                )
+
+        return missing
+
+    def _hash_file(self, file_path):
+        hasher = hashlib.sha256()
+        with open(file_path, 'rb') as f_stream:
+            for chunk in iter(lambda: f_stream.read(CHUNK_SIZE), b''):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+
+# Parse the SHA256 section of a Release/InRelease file into a list of
+# (path, size, sha256) tuples, and whether the suite supports by-hash
+def parse_release(contents):
+    files = []
+    by_hash = False
+    in_sha256 = False
+    for line in contents.split('\n'):
+        if line.startswith(' '):
+            if in_sha256:
+                hash_val, size, file_name = line.split()
+                files.append((file_name, int(size), hash_val))
+
+        else:
+            in_sha256 = line.startswith('SHA256:')
+            if line.startswith('Acquire-By-Hash:'):
+                by_hash = line.split(':', 1)[1].strip().lower() == 'yes'
+
+        # The signature of an InRelease file follows the Release contents
+        if line.startswith('-----BEGIN PGP SIGNATURE'):
+            break
+
+    return files, by_hash
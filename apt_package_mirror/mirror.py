@@ -13,19 +13,22 @@ import time
 import urllib
 import yaml
 
-class MirrorException(Exception):
-    def __init__(self, val):
-        self.val = val
+# xz compressed indices can only be read if the lzma module is available
+try:
+    import lzma
+except ImportError:
+    lzma = None
 
-    def __str__(self):
-        return repr(self.val)
+from apt_package_mirror.backends import HttpBackend, RsyncBackend
+from apt_package_mirror.exceptions import MirrorException
 
 class Mirror:
 
     # Setup class vars and logger
     def __init__(self, mirror_path, mirror_url,
                  temp_indices=None, log_file=None, log_level=None,
-                 package_ttl=None, hash_function=None):
+                 package_ttl=None, hash_function=None, fetch_method=None,
+                 dists=None, http_workers=None):
 
         if not temp_indices:
             self.temp_indices = '/tmp/dists-indices'
@@ -47,6 +50,9 @@ class Mirror:
         self.temp_indices = temp_indices
         self.indexed_packages = set()
 
+        if fetch_method is None:
+            fetch_method = 'rsync'
+
         self.logger = logging.getLogger()
         if log_level.upper() == 'DEBUG':
             self.logger.setLevel(logging.DEBUG)
@@ -79,8 +85,19 @@ class Mirror:
         self.logger.addHandler(fileHandler)
         self.logger.addHandler(console)
 
-    # Sync the whole mirror
-    def sync(self):
+        # The backend does the stages that download from the mirror we are
+        # cloning from
+        if fetch_method.lower() == 'rsync':
+            self.backend = RsyncBackend(self)
+
+        elif fetch_method.lower() == 'http':
+            self.backend = HttpBackend(self, dists, workers=http_workers)
+
+        else:
+            raise MirrorException("Unknown fetch method: " + fetch_method)
+
+    # Create the lock file, exit if another sync already holds it
+    def _lock(self):
         self.lock_file = os.path.join(self.temp_indices, 'sync_in_progress')
         if os.path.exists(self.lock_file):
             self.logger.info("Sync already in progress")
@@ -88,13 +105,19 @@ class Mirror:
 
         f = open(self.lock_file, 'w')
         f.close()
+
+    # Sync the whole mirror
+    # NOTE: The indices are staged before the pool is updated, so the pool has
+    #       every package the staged indices reference
+    def sync(self):
+        self._lock()
         try:
             self.logger.info("=======================================")
             self.logger.info("= Starting Sync of Mirror             =")
             self.logger.info("=======================================")
-            self.update_pool()
             self.get_dists_indices()
             self.get_zzz_dists()
+            self.update_pool()
             self.check_release_files()
             self.check_indices()
             self.update_mirrors()
@@ -108,66 +131,38 @@ class Mirror:
             os.remove(self.lock_file)
             raise
 
+    # Only grab new packages. The http backend finds new packages through the
+    # indices, which it stages in the same place as sync(), so it has to hold
+    # the lock while doing so
+    def update_packages(self):
+        if not self.backend.pool_from_indices:
+            self.update_pool()
+            return
+
+        self._lock()
+        try:
+            self.get_dists_indices()
+            self.get_zzz_dists()
+            self.update_pool()
+            os.remove(self.lock_file)
+        except:
+            self.logger.info("Exception caught, removing lock file")
+            os.remove(self.lock_file)
+            raise
+
     # Update the pool directory of the mirror
     # NOTE: This does not delete old packages, so it is safe to run at any time
     def update_pool(self):
-        rsync_command = "rsync --recursive --times --links --hard-links \
-                --contimeout=10 --timeout=10 --no-motd --stats \
-                --progress \
-                -vz rsync://{mirror_url}/pool {mirror_path}/"
-        rsync_command = rsync_command.format(
-                mirror_url=self.mirror_url,
-                mirror_path=self.mirror_path
-            )
-
-        self.logger.info("Downloading new packages")
-        rsync_status = Popen(rsync_command, stdout=PIPE, stderr=PIPE,
-                             shell=True)
-
-        for line in rsync_status.stdout:
-            self.logger.debug(line)
+        self.backend.update_pool()
 
     # Update the entire mirror, excluding package, source, and release indices
     def update_mirrors(self):
-        rsync_command = "rsync --recursive --times --links --hard-links \
-                --exclude 'Packages*' --exclude 'Sources*' \
-                --exclude 'Release*' --exclude 'ls-lR.gz' --exclude 'pool' \
-                --contimeout=10 --timeout=10 --no-motd --delete --stats \
-                --delay-updates --progress \
-                -vz rsync://{mirror_url}/ {mirror_path}/"
-        rsync_command = rsync_command.format(
-                mirror_url=self.mirror_url,
-                mirror_path=self.mirror_path
-            )
-
-        self.logger.info("Downloading all new files except indices")
-        rsync_status = Popen(rsync_command, stdout=PIPE, stderr=PIPE,
-                             shell=True)
-
-        for line in rsync_status.stdout:
-            self.logger.debug(line)
+        self.backend.update_mirrors()
 
     # Download the 'dists' directory and place it in a
     # temporary place so it can be checked to make sure it is accurate
     def get_dists_indices(self):
-        rsync_command = "rsync --recursive --times --links --hard-links \
-                --exclude 'installer*' --delete --no-motd --stats\
-                --progress \
-                -vz rsync://{mirror_url}/dists {temp_indices}/"
-        rsync_command = rsync_command.format(
-                mirror_url=self.mirror_url,
-                temp_indices=self.temp_indices
-            )
-
-        self.logger.info(
-                ("Downloading dist indices and storing them "
-                 "in a temporary place")
-            )
-        rsync_status = Popen(rsync_command, stdout=PIPE, stderr=PIPE,
-                             shell=True)
-
-        for line in rsync_status.stdout:
-            self.logger.debug(line)
+        self.backend.get_dists_indices()
 
     # Download the 'zzz-dists' directory and place it in a
     # temporary place so it can be checked to make sure it is accurate
@@ -175,48 +170,22 @@ class Mirror:
     #       ubuntu mirror because they do not have the 'zzz-dists' dir, but
     #       debian symlinks some things in the 'dists' dir to 'zzz-dists'
     def get_zzz_dists(self):
-        rsync_command = "rsync --recursive --times --links --hard-links \
-                --exclude 'installer*' --delete --no-motd --stats\
-                --progress \
-                -vz rsync://{mirror_url}/zzz-dists {temp_indices}/"
-        rsync_command = rsync_command.format(
-                mirror_url=self.mirror_url,
-                temp_indices=self.temp_indices
-            )
-
-        self.logger.info(
-                "Downloading zzz-dists and storing them in a temporary place"
-            )
-        rsync_status = Popen(rsync_command, stdout=PIPE, stderr=PIPE,
-                             shell=True)
-
-        for line in rsync_status.stdout:
-            self.logger.debug(line)
+        self.backend.get_zzz_dists()
 
     # Update the 'project' directory, delete the files that do not exist on the
     # mirror you are cloning from, then add an entry for our mirror in
     # project/trace
     def update_project_dir(self):
-        rsync_command = "rsync --recursive --times --links --hard-links \
-                --progress --delete -vz --stats --no-motd \
-                rsync://{mirror_url}/project {mirror_path}/ && date -u \
-                > ${mirror_path}/project/trace/$(hostname -f)"
-
-        rsync_command = rsync_command.format(
-                mirror_url=self.mirror_url,
-                mirror_path=self.mirror_path
-            )
-
-        self.logger.info("Updating 'project' directory")
-        rsync_status = Popen(rsync_command, stdout=PIPE, stderr=PIPE,
-                             shell=True)
-
-        for line in rsync_status.stdout:
-            self.logger.debug(line)
+        self.backend.update_project_dir()
 
     # Check that each index is accurate (Packages.gz and Sources.gz files)
     def check_indices(self):
-        dists_path = self.temp_indices
+        for index in self._pick_indices(self.temp_indices):
+            self.check_index(index)
+
+    # Pick one Sources and one Packages index out of each directory in the
+    # 'dists' directory, preferring the uncompressed ones
+    def _pick_indices(self, dists_path):
         self.logger.info("Gathering Indices")
         indices = self._get_indices(dists_path)
         dict_indices = {}
@@ -229,30 +198,33 @@ class Mirror:
             else:
                 dict_indices[dir_name] = dict_indices[dir_name] + [file_name]
 
+        picked = []
         for key in dict_indices.keys():
             if "Sources" in dict_indices[key]:
-                index = os.path.join(key, "Sources")
-                self.check_index(index)
+                picked.append(os.path.join(key, "Sources"))
 
             elif "Sources.gz" in dict_indices[key]:
-                index = os.path.join(key, "Sources.gz")
-                self.check_index(index)
+                picked.append(os.path.join(key, "Sources.gz"))
 
             elif "Sources.bz2" in dict_indices[key]:
-                index = os.path.join(key, "Sources.bz2")
-                self.check_index(index)
+                picked.append(os.path.join(key, "Sources.bz2"))
+
+            elif "Sources.xz" in dict_indices[key]:
+                picked.append(os.path.join(key, "Sources.xz"))
 
             if "Packages" in dict_indices[key]:
-                index = os.path.join(key, "Packages")
-                self.check_index(index)
+                picked.append(os.path.join(key, "Packages"))
 
             elif "Packages.gz" in dict_indices[key]:
-                index = os.path.join(key, "Packages.gz")
-                self.check_index(index)
+                picked.append(os.path.join(key, "Packages.gz"))
 
             elif "Packages.bz2" in dict_indices[key]:
-                index = os.path.join(key, "Packages.bz2")
-                self.check_index(index)
+                picked.append(os.path.join(key, "Packages.bz2"))
+
+            elif "Packages.xz" in dict_indices[key]:
+                picked.append(os.path.join(key, "Packages.xz"))
+
+        return picked
 
     # Find all of the 'Packages.gz' files and 'Sources.gz' files in the 'dists'
     # directory so the check_index() function can check their integrity
@@ -268,6 +240,8 @@ class Mirror:
         else:
             if re.match(".*(Packages|Sources)(\.gz|\.bz2)?$", dir):
                 return [dir]
+            elif lzma and re.match(".*(Packages|Sources)\.xz$", dir):
+                return [dir]
             else:
                 return []
 
@@ -275,21 +249,11 @@ class Mirror:
     # mirror actually exist (do not check the checksum of the file though as
     # that will take too much time)
     def check_index(self, file_name):
-        if not re.match(".*(\.gz|\.bz2)$", file_name):
-            with open(file_name, 'r') as f_stream:
-                f_contents = f_stream.read()
-
-        elif re.match(".*\.gz$", file_name):
-            with gzip.open(file_name, 'r') as f_stream:
-                f_contents = f_stream.read()
-
-        elif re.match(".*\.bz2$", file_name):
-            with bz2.BZ2File(file_name, 'r') as f_stream:
-                f_contents = f_stream.read()
+        f_contents = self._read_index(file_name)
 
         self.logger.debug("Checking index " + file_name)
 
-        if re.match(".*Packages(\.gz|\.bz2)?$", file_name):
+        if re.match(".*Packages(\.gz|\.bz2|\.xz)?$", file_name):
             for line in f_contents.split('\n'):
                 if line.startswith("Package:"):
                     package = line.split()[1]
@@ -302,8 +266,10 @@ class Mirror:
                         self.logger.error("Missing file: " + file_path)
                         raise MirrorException("Missing file: " + file_path)
 
-        if re.match(".*Sources(\.gz|\.bz2)?$", file_name):
+        if re.match(".*Sources(\.gz|\.bz2|\.xz)?$", file_name):
             lines_to_check = []
+            hash_type = None
+            dir_name = None
 
             for line in f_contents.split('\n'):
                 if line.startswith("Package:"):
@@ -332,11 +298,41 @@ class Mirror:
                             self.logger.error("Missing file: " + file_path)
                             raise MirrorException("Missing file: " + file_path)
 
-                elif not line.startswith(" "):
                     hash_type = None
                     dir_name = None
                     lines_to_check = []
 
+                # The Directory field can come after the Files field, so only
+                # the end of the stanza resets it
+                elif not line.startswith(" "):
+                    hash_type = None
+
+    # Read an index, decompressing it if needed
+    def _read_index(self, file_name):
+        if not re.match(".*(\.gz|\.bz2|\.xz)$", file_name):
+            with open(file_name, 'r') as f_stream:
+                f_contents = f_stream.read()
+
+        elif re.match(".*\.gz$", file_name):
+            with gzip.open(file_name, 'r') as f_stream:
+                f_contents = f_stream.read()
+
+        elif re.match(".*\.bz2$", file_name):
+            with bz2.BZ2File(file_name, 'r') as f_stream:
+                f_contents = f_stream.read()
+
+        elif re.match(".*\.xz$", file_name):
+            if not lzma:
+                raise MirrorException("Can not read xz index " + file_name)
+
+            with lzma.open(file_name, 'r') as f_stream:
+                f_contents = f_stream.read()
+
+        if not isinstance(f_contents, str):
+            f_contents = f_contents.decode('utf-8')
+
+        return f_contents
+
     # Check each release file to make sure it is accurate
     def check_release_files(self):
         self.logger.info("Gathering Release Files")
@@ -344,7 +340,8 @@ class Mirror:
         for file in release_files:
             self.check_release_file(file)
 
-    # Find all the 'Release' files in the 'dists' directory
+    # Find all the 'Release' files in the 'dists' directory. Where there is an
+    # 'InRelease' file it is used instead, it is the one clients use first
     def _get_release_files(self, dir):
         if not os.path.isfile(dir):
             indices = []
@@ -355,7 +352,10 @@ class Mirror:
             return indices
 
         else:
-            if dir.endswith("/Release"):
+            if dir.endswith("/InRelease"):
+                return [dir]
+            elif dir.endswith("/Release") and not os.path.isfile(
+                    os.path.join(os.path.dirname(dir), "InRelease")):
                 return [dir]
             else:
                 return []
@@ -374,7 +374,11 @@ class Mirror:
 
         hash_type = None
         for line in f_contents.split('\n'):
-            if line.startswith("MD5Sum"):
+            # The signature of an InRelease file follows the Release contents
+            if line.startswith("-----BEGIN PGP SIGNATURE"):
+                break
+
+            elif line.startswith("MD5Sum"):
                 current_hash_type = "MD5SUM"
 
             elif line.startswith("SHA1"):
@@ -390,7 +394,7 @@ class Mirror:
 
                 if os.path.isfile(file_path):
 
-                    with open(file_path, 'r') as f_stream:
+                    with open(file_path, 'rb') as f_stream:
                         file_path_contents = f_stream.read()
 
                     if self.hash_function == "MD5SUM":
@@ -474,15 +478,8 @@ class Mirror:
 
     def clean(self):
         file_name = os.path.join(self.temp_indices, 'files_to_delete')
-        rsync_command = "rsync --recursive --times --links --hard-links \
-                --contimeout=10 --timeout=10 --no-motd --stats --delete \
-                --progress -nvz rsync://{mirror_url}/pool {mirror_path}/"
-        rsync_command = rsync_command.format(
-            mirror_url=self.mirror_url, mirror_path=self.mirror_path
-        )
-
         self.logger.info("Checking for files to delete")
-        rsync_status = Popen(rsync_command, stdout=PIPE, stderr=PIPE, shell=True)
+        deleted_packages = self.backend.get_deleted_packages()
 
         now_num = int(time.time())
         now = str(now_num)
@@ -502,10 +499,8 @@ class Mirror:
 
         file_contents[now] = []
 
-        for line in rsync_status.stdout:
-            if re.match('^deleting', line):
-                package = line.split()[1]
-                file_contents[now].append(package)
+        for package in deleted_packages:
+            file_contents[now].append(package)
 
         for key in file_contents.keys():
             for package in file_contents[key]:
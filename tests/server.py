@@ -0,0 +1,113 @@
+import hashlib
+import os
+import threading
+
+try:
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+
+# A plain http.server serving a directory, it ignores Range headers
+class TreeHandler(SimpleHTTPRequestHandler):
+
+    def translate_path(self, path):
+        path = SimpleHTTPRequestHandler.translate_path(self, path)
+        return os.path.join(self.server.root,
+                            os.path.relpath(path, os.getcwd()))
+
+    def log_message(self, *args):
+        pass
+
+    def send_head(self):
+        self.server.requests.append(
+            (self.path, self.headers.get('Range'),
+             self.headers.get('If-Range'), self.client_address)
+        )
+        return SimpleHTTPRequestHandler.send_head(self)
+
+
+# Serves the same directory with keep-alive, ETags, Range and If-Range
+# support. server.redirects maps paths to a Location (None for a redirect
+# without one), server.force_416 answers every Range request with a 416.
+class RangeHandler(TreeHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        self.server.requests.append(
+            (self.path, range_header, if_range, self.client_address)
+        )
+
+        if self.path in self.server.redirects:
+            self.send_response(302)
+            location = self.server.redirects[self.path]
+            if location:
+                self.send_header('Location', location)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        file_path = self.translate_path(self.path)
+        if not os.path.isfile(file_path):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        with open(file_path, 'rb') as f_stream:
+            data = f_stream.read()
+        etag = '"' + hashlib.sha256(data).hexdigest()[:16] + '"'
+
+        start = 0
+        if range_header and (if_range is None or if_range == etag):
+            start = int(range_header.split('=')[1].split('-')[0])
+            if self.server.force_416 or start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */' + str(len(data)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+
+class Server(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, root, handler):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.root = root
+        self.requests = []
+        self.redirects = {}
+        self.force_416 = False
+
+
+# Start a server for root in a background thread
+def start_server(root, handler=RangeHandler):
+    server = Server(root, handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    server.url = 'http://127.0.0.1:%d/' % server.server_address[1]
+    return server
+
+
+def stop_server(server):
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,315 @@
+import gzip
+import hashlib
+import io
+import logging
+try:
+    import lzma
+except ImportError:
+    lzma = None
+import os
+import shutil
+import tempfile
+import unittest
+
+from apt_package_mirror.mirror import Mirror
+from tests.server import start_server, stop_server
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def gzipped(data):
+    buf = io.BytesIO()
+    f_stream = gzip.GzipFile(fileobj=buf, mode='wb', mtime=0)
+    f_stream.write(data)
+    f_stream.close()
+    return buf.getvalue()
+
+
+DEB = b'deb contents' * 100
+DSC = b'dsc contents'
+PACKAGES = (
+    "Package: foo\n"
+    "Filename: pool/main/f/foo/foo_1.deb\n"
+    "Size: %d\n"
+    "SHA256: %s\n"
+    % (len(DEB), sha256(DEB))
+).encode()
+# Fields in the order Debian publishes them, Directory comes last
+SOURCES = (
+    "Package: foo\n"
+    "Files:\n"
+    " %s %d foo_1.dsc\n"
+    "Checksums-Sha256:\n"
+    " %s %d foo_1.dsc\n"
+    "Directory: pool/main/f/foo\n"
+    % (hashlib.md5(DSC).hexdigest(), len(DSC), sha256(DSC), len(DSC))
+).encode()
+COMPONENT_RELEASE = b"Component: main\nArchitecture: amd64\n"
+
+# (name in the Release file, contents, published by-hash)
+INDICES = [
+    ('main/binary-amd64/Packages', PACKAGES, False),
+    ('main/binary-amd64/Packages.gz', gzipped(PACKAGES), True),
+    ('main/binary-amd64/Release', COMPONENT_RELEASE, False),
+    ('main/source/Sources.gz', gzipped(SOURCES), True),
+    ('main/installer-amd64/current/images/SHA256SUMS', b'x', True),
+]
+
+
+class HttpBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.upstream = tempfile.mkdtemp()
+        self.mirror_path = tempfile.mkdtemp()
+        self.temp_indices = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.temp_indices, 'log')
+
+        self.release = "Suite: s\nAcquire-By-Hash: yes\nSHA256:\n"
+        for name, contents, by_hash in INDICES:
+            if name == 'main/binary-amd64/Packages':
+                self.add_index(name, contents, by_hash, publish=False)
+            else:
+                self.add_index(name, contents, by_hash)
+
+        # A canonical index that changed since the InRelease was published,
+        # it must not be used when the by-hash copy exists
+        self.write_upstream('dists/s/main/binary-amd64/Packages.gz', b'new')
+        self.write_upstream('pool/main/f/foo/foo_1.deb', DEB)
+        self.write_upstream('pool/main/f/foo/foo_1.dsc', DSC)
+
+        self.server = start_server(self.upstream)
+        self.handlers = logging.getLogger().handlers[:]
+        self.mirror = Mirror(self.mirror_path, self.server.url,
+                             temp_indices=self.temp_indices,
+                             log_file=self.log_file, log_level='warning',
+                             fetch_method='http', dists=['s'])
+        self.backend = self.mirror.backend
+
+    def tearDown(self):
+        self.backend.fetcher.close()
+        stop_server(self.server)
+        logging.getLogger().handlers = self.handlers
+        shutil.rmtree(self.upstream)
+        shutil.rmtree(self.mirror_path)
+        shutil.rmtree(self.temp_indices)
+
+    def write_upstream(self, path, contents):
+        path = os.path.join(self.upstream, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f_stream:
+            f_stream.write(contents)
+
+    # List an index in the InRelease file and publish it
+    def add_index(self, name, contents, by_hash=False, publish=True):
+        self.release += " %s %d %s\n" % (sha256(contents), len(contents), name)
+        if publish and by_hash:
+            self.write_upstream(
+                os.path.join('dists/s', os.path.dirname(name), 'by-hash',
+                             'SHA256', sha256(contents)),
+                contents
+            )
+        elif publish:
+            self.write_upstream('dists/s/' + name, contents)
+
+        self.write_upstream('dists/s/InRelease', self.release.encode())
+
+    def staged(self, path):
+        return os.path.join(self.temp_indices, 'dists', 's', path)
+
+    def read_log(self):
+        with open(self.log_file) as f_stream:
+            return f_stream.read()
+
+    def test_indices_are_fetched_by_hash(self):
+        self.backend.get_dists_indices()
+
+        packages = self.staged('main/binary-amd64/Packages.gz')
+        by_hash = self.staged('main/binary-amd64/by-hash/SHA256/' +
+                              sha256(INDICES[1][1]))
+        self.assertEqual(os.stat(packages).st_ino, os.stat(by_hash).st_ino)
+        self.assertTrue(os.path.isfile(self.staged('main/source/Sources.gz')))
+        self.assertFalse(os.path.exists(self.staged('main/installer-amd64')))
+        self.assertTrue(self.backend.indices_complete)
+
+    def test_falls_back_to_canonical_path(self):
+        self.backend.get_dists_indices()
+
+        with open(self.staged('main/binary-amd64/Release'), 'rb') as f:
+            self.assertEqual(f.read(), COMPONENT_RELEASE)
+        self.assertIn("not found on mirror: main/binary-amd64/Packages\n",
+                      self.read_log())
+
+    def test_stale_release_partial_is_not_resumed(self):
+        os.makedirs(self.staged(''))
+        with open(self.staged('InRelease.partial'), 'wb') as f:
+            f.write(b'GARBAGE-FROM-OLD-RUN\n')
+
+        self.backend.get_dists_indices()
+
+        with open(self.staged('InRelease'), 'rb') as f:
+            self.assertTrue(f.read().startswith(b'Suite: s\n'))
+        self.assertFalse(os.path.exists(self.staged('InRelease.partial')))
+
+    def test_stale_indices_are_removed(self):
+        os.makedirs(self.staged('old'))
+        with open(self.staged('old/Packages'), 'wb') as f:
+            f.write(b'old')
+
+        self.backend.get_dists_indices()
+        self.assertFalse(os.path.exists(self.staged('old/Packages')))
+
+    def test_update_pool(self):
+        self.backend.get_dists_indices()
+        self.mirror.update_pool()
+        self.mirror.check_indices()
+
+        for name, contents in (('foo_1.deb', DEB), ('foo_1.dsc', DSC)):
+            path = os.path.join(self.mirror_path, 'pool/main/f/foo', name)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), contents)
+
+    def test_get_index_files(self):
+        packages = os.path.join(self.temp_indices, 'Packages')
+        with open(packages, 'wb') as f_stream:
+            f_stream.write(PACKAGES + b"\nPackage: nohash\n"
+                           b"Filename: pool/main/n/nohash/nohash_1.deb\n"
+                           b"Size: 3\n")
+
+        sources = os.path.join(self.temp_indices, 'Sources.gz')
+        with open(sources, 'wb') as f_stream:
+            f_stream.write(gzipped(SOURCES + b"\nPackage: nodir\n"
+                                   b"Checksums-Sha256:\n aaaa 1 nodir_1.dsc\n"))
+
+        self.assertEqual(
+            self.backend._get_index_files(packages),
+            [('pool/main/f/foo/foo_1.deb', len(DEB), sha256(DEB))]
+        )
+        self.assertEqual(
+            self.backend._get_index_files(sources),
+            [('pool/main/f/foo/foo_1.dsc', len(DSC), sha256(DSC))]
+        )
+        log = self.read_log()
+        self.assertIn("Skipping pool/main/n/nohash/nohash_1.deb", log)
+        self.assertIn("Skipping source package nodir", log)
+
+    def test_get_deleted_packages(self):
+        self.backend.get_dists_indices()
+        self.mirror.update_pool()
+        self.mirror.check_indices()
+        self.write_stray_package()
+
+        self.assertEqual(self.backend.get_deleted_packages(),
+                         ['pool/main/s/stray/stray_1.deb'])
+
+    def test_no_deletions_without_indexed_packages(self):
+        self.backend.get_dists_indices()
+        self.write_stray_package()
+        self.assertEqual(self.backend.get_deleted_packages(), [])
+
+    def test_no_deletions_with_missing_index(self):
+        shutil.rmtree(os.path.join(self.upstream, 'dists/s/main/source'))
+        self.backend.get_dists_indices()
+        self.mirror.update_pool()
+        self.mirror.check_indices()
+        self.write_stray_package()
+
+        self.assertFalse(self.backend.indices_complete)
+        self.assertEqual(self.backend.get_deleted_packages(), [])
+        self.assertIn("No readable copy of s/main/source/Sources",
+                      self.read_log())
+
+    def write_stray_package(self):
+        path = os.path.join(self.mirror_path, 'pool/main/s/stray/stray_1.deb')
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f_stream:
+            f_stream.write(b'stray')
+
+    def test_unsafe_pool_files_are_skipped(self):
+        packages = os.path.join(self.temp_indices, 'Packages')
+        with open(packages, 'wb') as f_stream:
+            f_stream.write(
+                b"Package: up\nFilename: ../escape\nSize: 1\nSHA256: a\n\n"
+                b"Package: abs\nFilename: /etc/escape\nSize: 1\nSHA256: a\n\n"
+                b"Package: out\nFilename: dists/escape\nSize: 1\nSHA256: a\n"
+            )
+
+        sources = os.path.join(self.temp_indices, 'Sources')
+        with open(sources, 'wb') as f_stream:
+            f_stream.write(b"Package: up\nDirectory: pool/../..\n"
+                           b"Checksums-Sha256:\n aaaa 1 escape.dsc\n")
+
+        self.assertEqual(self.backend._get_index_files(packages), [])
+        self.assertEqual(self.backend._get_index_files(sources), [])
+        log = self.read_log()
+        for name in ('../escape', '/etc/escape', 'dists/escape',
+                     'pool/../../escape.dsc'):
+            self.assertIn("Skipping " + name + " in ", log)
+
+    def test_unsafe_release_entries_are_skipped(self):
+        self.add_index('../../escape', b'escaped', publish=False)
+        self.write_upstream('escape', b'escaped')
+
+        self.backend.get_dists_indices()
+
+        self.assertFalse(os.path.exists(os.path.join(self.temp_indices,
+                                                     'escape')))
+        self.assertIn("Skipping unsafe entry ../../escape", self.read_log())
+
+    @unittest.skipUnless(lzma, "needs the lzma module")
+    def test_xz_only_component(self):
+        bar = b'bar contents'
+        self.write_upstream('pool/contrib/b/bar/bar_1.deb', bar)
+        self.add_index('contrib/binary-amd64/Packages.xz', lzma.compress((
+            "Package: bar\n"
+            "Filename: pool/contrib/b/bar/bar_1.deb\n"
+            "Size: %d\n"
+            "SHA256: %s\n" % (len(bar), sha256(bar))
+        ).encode()))
+
+        self.backend.get_dists_indices()
+        self.mirror.update_pool()
+        self.mirror.check_indices()
+
+        self.assertTrue(self.backend.indices_complete)
+        self.assertIn('pool/contrib/b/bar/bar_1.deb',
+                      self.mirror.indexed_packages)
+        self.assertEqual(self.backend.get_deleted_packages(), [])
+
+    def test_unreadable_only_component_blocks_deletion(self):
+        self.add_index('contrib/binary-amd64/Packages.zst', b'zstd')
+        self.backend.get_dists_indices()
+        self.mirror.update_pool()
+        self.mirror.check_indices()
+        self.write_stray_package()
+
+        self.assertFalse(self.backend.indices_complete)
+        self.assertEqual(self.backend.get_deleted_packages(), [])
+        self.assertIn("No readable copy of s/contrib/binary-amd64/Packages",
+                      self.read_log())
+
+    def test_indices_are_checked_against_inrelease(self):
+        # Release was published after InRelease, mid mirror push
+        self.write_upstream('dists/s/Release', b"Suite: s\nSHA256:\n")
+        self.write_upstream('dists/s/Release.gpg', b"signature")
+
+        self.backend.get_dists_indices()
+        self.mirror.check_release_files()
+
+        self.assertFalse(os.path.exists(self.staged('Release')))
+        self.assertFalse(os.path.exists(self.staged('Release.gpg')))
+        self.assertIn("Release for s does not match InRelease",
+                      self.read_log())
+
+        with open(self.staged('Release'), 'wb') as f_stream:
+            f_stream.write(b"Suite: s\n")
+        release_files = self.mirror._get_release_files(self.staged(''))
+        self.assertIn(self.staged('InRelease'), release_files)
+        self.assertNotIn(self.staged('Release'), release_files)
+
+    def test_matching_release_is_staged(self):
+        self.write_upstream('dists/s/Release', self.release.encode())
+        self.backend.get_dists_indices()
+        self.assertTrue(os.path.exists(self.staged('Release')))
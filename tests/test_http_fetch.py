@@ -0,0 +1,190 @@
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from apt_package_mirror.exceptions import MirrorException
+from apt_package_mirror.http_fetch import HttpFetcher, parse_release
+from tests.server import TreeHandler, start_server, stop_server
+
+DATA = b''.join(str(i).encode() for i in range(50000))
+SHA256 = hashlib.sha256(DATA).hexdigest()
+ETAG = '"' + SHA256[:16] + '"'
+
+
+class HttpFetcherTest(unittest.TestCase):
+
+    handler = None
+
+    def setUp(self):
+        self.upstream = tempfile.mkdtemp()
+        self.local = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.upstream, 'base'))
+        with open(os.path.join(self.upstream, 'base', 'file'), 'wb') as f:
+            f.write(DATA)
+
+        if self.handler:
+            self.server = start_server(self.upstream, self.handler)
+        else:
+            self.server = start_server(self.upstream)
+        self.fetcher = HttpFetcher(self.server.url + 'base',
+                                   logger=logging.getLogger(__name__))
+        self.local_path = os.path.join(self.local, 'sub', 'file')
+        self.partial_path = self.local_path + '.partial'
+
+    def tearDown(self):
+        self.fetcher.close()
+        stop_server(self.server)
+        shutil.rmtree(self.upstream)
+        shutil.rmtree(self.local)
+
+    def write_partial(self, contents, validator=None):
+        os.makedirs(os.path.dirname(self.partial_path))
+        with open(self.partial_path, 'wb') as f:
+            f.write(contents)
+        if validator:
+            with open(self.partial_path + '.validator', 'w') as f:
+                f.write(validator)
+
+    def read_local(self):
+        with open(self.local_path, 'rb') as f:
+            return f.read()
+
+    def assert_no_partial(self):
+        self.assertFalse(os.path.exists(self.partial_path))
+        self.assertFalse(os.path.exists(self.partial_path + '.validator'))
+
+
+class FetchTest(HttpFetcherTest):
+
+    def test_fetch(self):
+        self.assertTrue(self.fetcher.fetch('file', self.local_path,
+                                           len(DATA), SHA256))
+        self.assertEqual(self.read_local(), DATA)
+        self.assert_no_partial()
+
+    def test_not_found(self):
+        self.assertFalse(self.fetcher.fetch('nope', self.local_path))
+        self.assertEqual(
+            self.fetcher.fetch_all([('nope', self.local_path, 1, 'x')]),
+            ['nope']
+        )
+
+    def test_sha256_mismatch(self):
+        self.assertRaises(MirrorException, self.fetcher.fetch, 'file',
+                          self.local_path, len(DATA), '0' * 64)
+        self.assertFalse(os.path.exists(self.local_path))
+        self.assert_no_partial()
+
+    def test_fetch_all_raises_on_failure(self):
+        files = [('file', self.local_path, len(DATA), '0' * 64),
+                 ('file', os.path.join(self.local, 'ok'), len(DATA), SHA256)]
+        self.assertRaises(MirrorException, self.fetcher.fetch_all, files)
+        self.assertTrue(os.path.isfile(os.path.join(self.local, 'ok')))
+
+    def test_existing_file_is_kept(self):
+        os.makedirs(os.path.dirname(self.local_path))
+        with open(self.local_path, 'wb') as f:
+            f.write(b'x' * len(DATA))
+
+        self.fetcher.fetch('file', self.local_path, len(DATA), SHA256)
+        self.assertEqual(self.server.requests, [])
+
+        self.fetcher.fetch('file', self.local_path, len(DATA), SHA256,
+                           quick=False)
+        self.assertEqual(self.read_local(), DATA)
+
+    def test_connections_are_reused(self):
+        self.fetcher.fetch('file', self.local_path)
+        self.fetcher.fetch('file', self.local_path)
+        clients = set(request[3] for request in self.server.requests)
+        self.assertEqual(len(clients), 1)
+
+    def test_resume(self):
+        self.write_partial(DATA[:1000], ETAG)
+        self.fetcher.fetch('file', self.local_path, len(DATA), SHA256)
+        self.assertEqual(self.server.requests[0][1:3], ('bytes=1000-', ETAG))
+        self.assertEqual(self.read_local(), DATA)
+        self.assert_no_partial()
+
+    def test_resume_changed_file_restarts(self):
+        self.write_partial(b'old contents', '"old"')
+        self.fetcher.fetch('file', self.local_path, len(DATA), SHA256)
+        self.assertEqual(self.server.requests[0][2], '"old"')
+        self.assertEqual(self.read_local(), DATA)
+
+    def test_416_restarts(self):
+        self.server.force_416 = True
+        self.write_partial(DATA[:1000], ETAG)
+        self.fetcher.fetch('file', self.local_path, len(DATA), SHA256)
+        self.assertEqual([r[1] for r in self.server.requests],
+                         ['bytes=1000-', None])
+        self.assertEqual(self.read_local(), DATA)
+
+    def test_partial_is_not_resumed_without_hash(self):
+        self.write_partial(b'GARBAGE-FROM-OLD-RUN\n', ETAG)
+        self.fetcher.fetch('file', self.local_path)
+        self.assertEqual(self.server.requests[0][1], None)
+        self.assertEqual(self.read_local(), DATA)
+        self.assert_no_partial()
+
+    def test_partial_is_not_resumed_without_validator(self):
+        self.write_partial(DATA[:1000])
+        self.fetcher.fetch('file', self.local_path, len(DATA), SHA256)
+        self.assertEqual(self.server.requests[0][1], None)
+        self.assertEqual(self.read_local(), DATA)
+
+    def test_redirect(self):
+        self.server.redirects['/base/moved'] = '/base/file'
+        self.fetcher.fetch('moved', self.local_path, len(DATA), SHA256)
+        self.assertEqual(self.read_local(), DATA)
+
+    def test_redirect_without_location(self):
+        self.server.redirects['/base/moved'] = None
+        try:
+            self.fetcher.fetch('moved', self.local_path)
+            self.fail("No exception raised")
+        except MirrorException as e:
+            self.assertIn('302 redirect without Location', str(e))
+
+
+class FetchIgnoringRangeTest(HttpFetcherTest):
+
+    handler = TreeHandler
+
+    def test_range_ignored_restarts(self):
+        self.write_partial(DATA[:1000], ETAG)
+        self.fetcher.fetch('file', self.local_path, len(DATA), SHA256)
+        self.assertEqual(self.server.requests[0][1], 'bytes=1000-')
+        self.assertEqual(self.read_local(), DATA)
+        self.assert_no_partial()
+
+
+class ParseReleaseTest(unittest.TestCase):
+
+    def test_parse_release(self):
+        release = (
+            "-----BEGIN PGP SIGNED MESSAGE-----\n"
+            "Hash: SHA256\n"
+            "\n"
+            "Suite: s\n"
+            "Acquire-By-Hash: yes\n"
+            "MD5Sum:\n"
+            " d41d8cd98f00b204e9800998ecf8427e 0 main/binary-amd64/Packages\n"
+            "SHA256:\n"
+            " aaaa 10 main/binary-amd64/Packages\n"
+            " bbbb 20 main/source/Sources.gz\n"
+            "-----BEGIN PGP SIGNATURE-----\n"
+            " cccc 30 not/a/file\n"
+        )
+        files, by_hash = parse_release(release)
+        self.assertTrue(by_hash)
+        self.assertEqual(files, [('main/binary-amd64/Packages', 10, 'aaaa'),
+                                 ('main/source/Sources.gz', 20, 'bbbb')])
+
+    def test_parse_release_without_by_hash(self):
+        files, by_hash = parse_release("SHA256:\n aaaa 1 Contents\n")
+        self.assertFalse(by_hash)
+        self.assertEqual(files, [('Contents', 1, 'aaaa')])